@@ -1,6 +1,7 @@
 import math
+from functools import lru_cache
 from typing import Any
-from einops import rearrange
+from einops.layers.torch import Rearrange
 import torch
 from diffusers.models.attention_processor import Attention
 
@@ -11,6 +12,15 @@ from diffusers.models.attention_processor import Attention
 
 EPSILON = 1e-6
 
+# einops parses the pattern string on every rearrange() call; build the recipes once and reuse them
+_EXPAND_MASK = Rearrange("b n -> b 1 1 n")
+_MERGE_HEADS = Rearrange("b h n d -> b n (h d)")
+
+
+@lru_cache(maxsize=None)
+def _split_heads(h):
+    return Rearrange("b n (h d) -> b h n d", h=h)
+
 
 class FlashAttentionFunction(torch.autograd.function.Function):
     @staticmethod
@@ -34,7 +44,7 @@ class FlashAttentionFunction(torch.autograd.function.Function):
         if mask is None:
             mask = (None,) * math.ceil(q.shape[-2] / q_bucket_size)
         else:
-            mask = rearrange(mask, "b n -> b 1 1 n")
+            mask = _EXPAND_MASK(mask)
             mask = mask.split(q_bucket_size, dim=-1)
 
         row_splits = zip(
@@ -214,13 +224,13 @@ class FlashAttnProcessor:
         v = attn.to_v(context_v)
         del encoder_hidden_states, hidden_states
 
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q, k, v))
+        q, k, v = map(_split_heads(h), (q, k, v))
 
         out = FlashAttentionFunction.apply(
             q, k, v, attention_mask, False, q_bucket_size, k_bucket_size
         )
 
-        out = rearrange(out, "b h n d -> b n (h d)")
+        out = _MERGE_HEADS(out)
 
         out = attn.to_out[0](out)
         out = attn.to_out[1](out)
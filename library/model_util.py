@@ -1,14 +1,19 @@
 # v1: split from train_db_fixed.py.
 # v2: support safetensors
 
+import functools
 import math
 import os
+import re
+from typing import List
 
 import torch
 from library.device_utils import init_ipex
 init_ipex()
 
 import diffusers
+from accelerate import init_empty_weights
+from accelerate.utils.modeling import set_module_tensor_to_device
 from transformers import CLIPTextModel, CLIPTokenizer, CLIPTextConfig, logging
 from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline  # , UNet2DConditionModel
 from safetensors.torch import load_file, save_file
@@ -672,7 +677,8 @@ def conv_transformer_to_linear(checkpoint):
                 checkpoint[key] = checkpoint[key][:, :, 0, 0]
 
 
-def convert_unet_state_dict_to_sd(v2, unet_state_dict):
+@functools.lru_cache(maxsize=None)
+def _unet_conversion_tables():
     unet_conversion_map = [
         # (stable-diffusion, HF Diffusers)
         ("time_embed.0.weight", "time_embedding.linear_1.weight"),
@@ -745,22 +751,29 @@ def convert_unet_state_dict_to_sd(v2, unet_state_dict):
         sd_mid_res_prefix = f"middle_block.{2*j}."
         unet_conversion_map_layer.append((sd_mid_res_prefix, hf_mid_res_prefix))
 
+    # precompile the replacements into dicts plus one alternation regex per pass, so conversion
+    # does a single scan per key instead of iterating every pattern for every key
+    direct_map = {hf_name: sd_name for sd_name, hf_name in unet_conversion_map}
+    resnet_map = {hf_part: sd_part for sd_part, hf_part in unet_conversion_map_resnet}
+    layer_map = {hf_part: sd_part for sd_part, hf_part in unet_conversion_map_layer}
+    resnet_re = re.compile("|".join(re.escape(hf_part) for hf_part in resnet_map))
+    layer_re = re.compile("|".join(re.escape(hf_part) for hf_part in layer_map))
+    return direct_map, resnet_map, resnet_re, layer_map, layer_re
+
+
+def convert_unet_state_dict_to_sd(v2, unet_state_dict):
+    direct_map, resnet_map, resnet_re, layer_map, layer_re = _unet_conversion_tables()
+
     # buyer beware: this is a *brittle* function,
     # and correct output requires that all of these pieces interact in
     # the exact order in which I have arranged them.
-    mapping = {k: k for k in unet_state_dict.keys()}
-    for sd_name, hf_name in unet_conversion_map:
-        mapping[hf_name] = sd_name
-    for k, v in mapping.items():
-        if "resnets" in k:
-            for sd_part, hf_part in unet_conversion_map_resnet:
-                v = v.replace(hf_part, sd_part)
-            mapping[k] = v
-    for k, v in mapping.items():
-        for sd_part, hf_part in unet_conversion_map_layer:
-            v = v.replace(hf_part, sd_part)
-        mapping[k] = v
-    new_state_dict = {v: unet_state_dict[k] for k, v in mapping.items()}
+    new_state_dict = {}
+    for k, value in unet_state_dict.items():
+        v = direct_map.get(k, k)
+        if "resnets" in v:
+            v = resnet_re.sub(lambda m: resnet_map[m.group(0)], v)
+        v = layer_re.sub(lambda m: layer_map[m.group(0)], v)
+        new_state_dict[v] = value
 
     if v2:
         conv_transformer_to_linear(new_state_dict)
@@ -877,7 +890,8 @@ def reshape_weight_for_sd(w):
     return w.reshape(*w.shape, 1, 1)
 
 
-def convert_vae_state_dict(vae_state_dict):
+@functools.lru_cache(maxsize=None)
+def _vae_conversion_tables():
     vae_conversion_map = [
         # (stable-diffusion, HF Diffusers)
         ("nin_shortcut", "conv_shortcut"),
@@ -933,17 +947,24 @@ def convert_vae_state_dict(vae_state_dict):
             ("proj_out.", "to_out.0."),
         ]
 
-    mapping = {k: k for k in vae_state_dict.keys()}
-    for k, v in mapping.items():
-        for sd_part, hf_part in vae_conversion_map:
-            v = v.replace(hf_part, sd_part)
-        mapping[k] = v
-    for k, v in mapping.items():
+    main_map = {hf_part: sd_part for sd_part, hf_part in vae_conversion_map}
+    main_re = re.compile("|".join(re.escape(hf_part) for hf_part in main_map))
+    attn_map = {hf_part: sd_part for sd_part, hf_part in vae_conversion_map_attn}
+    attn_re = re.compile("|".join(re.escape(hf_part) for hf_part in attn_map))
+    return main_map, main_re, attn_map, attn_re
+
+
+def convert_vae_state_dict(vae_state_dict):
+    # one compiled-alternation pass per key instead of trying every pattern on every key
+    main_map, main_re, attn_map, attn_re = _vae_conversion_tables()
+
+    new_state_dict = {}
+    for k, value in vae_state_dict.items():
+        v = main_re.sub(lambda m: main_map[m.group(0)], k)
         if "attentions" in k:
-            for sd_part, hf_part in vae_conversion_map_attn:
-                v = v.replace(hf_part, sd_part)
-            mapping[k] = v
-    new_state_dict = {v: vae_state_dict[k] for k, v in mapping.items()}
+            v = attn_re.sub(lambda m: attn_map[m.group(0)], v)
+        new_state_dict[v] = value
+
     weights_to_convert = ["q", "k", "v", "proj_out"]
     for k, v in new_state_dict.items():
         for weight_name in weights_to_convert:
@@ -963,6 +984,38 @@ def is_safetensors(path):
     return os.path.splitext(path)[1].lower() == ".safetensors"
 
 
+# load state_dict without allocating new tensors
+def load_state_dict_on_device(model, state_dict, device, dtype=None):
+    # dtype will use fp32 as default
+    missing_keys = list(model.state_dict().keys() - state_dict.keys())
+    unexpected_keys = list(state_dict.keys() - model.state_dict().keys())
+
+    # pin CPU tensors so the host to device copies run from page-locked memory instead of
+    # faulting in the mmap'ed checkpoint page by page
+    pin_memory = torch.device(device).type == "cuda" if device is not None else False
+
+    # similar to model.load_state_dict()
+    if not missing_keys and not unexpected_keys:
+        for k in list(state_dict.keys()):
+            value = state_dict.pop(k)
+            if pin_memory and value.device.type == "cpu":
+                value = value.pin_memory()
+            # pass the requested dtype straight through: with dtype=None accelerate casts
+            # the value to the meta-built parameter's dtype (fp32), which would upcast
+            # checkpoints that already hold the requested half dtype
+            set_module_tensor_to_device(model, k, device, value=value, dtype=dtype)
+        return "<All keys matched successfully>"
+
+    # error_msgs
+    error_msgs: List[str] = []
+    if missing_keys:
+        error_msgs.insert(0, "Missing key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in missing_keys)))
+    if unexpected_keys:
+        error_msgs.insert(0, "Unexpected key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in unexpected_keys)))
+
+    raise RuntimeError("Error(s) in loading state_dict for {}:\n\t{}".format(model.__class__.__name__, "\n\t".join(error_msgs)))
+
+
 def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
     # text encoderの格納形式が違うモデルに対応する ('text_model'がない)
     TEXT_ENCODER_KEY_REPLACEMENTS = [
@@ -982,16 +1035,18 @@ def load_checkpoint_with_text_encoder_conversion(ckpt_path, device="cpu"):
             state_dict = checkpoint
             checkpoint = None
 
-    key_reps = []
-    for rep_from, rep_to in TEXT_ENCODER_KEY_REPLACEMENTS:
-        for key in state_dict.keys():
+    # rebuild the dict in one pass: renaming keys via insert+delete rehashes the
+    # table for every replaced key and rescans all keys once per replacement
+    new_state_dict = {}
+    for key, value in state_dict.items():
+        for rep_from, rep_to in TEXT_ENCODER_KEY_REPLACEMENTS:
             if key.startswith(rep_from):
-                new_key = rep_to + key[len(rep_from) :]
-                key_reps.append((key, new_key))
-
-    for key, new_key in key_reps:
-        state_dict[new_key] = state_dict[key]
-        del state_dict[key]
+                key = rep_to + key[len(rep_from) :]
+                break
+        new_state_dict[key] = value
+    state_dict = new_state_dict
+    if checkpoint is not None:
+        checkpoint["state_dict"] = state_dict
 
     return checkpoint, state_dict
 
@@ -1004,16 +1059,20 @@ def load_models_from_stable_diffusion_checkpoint(v2, ckpt_path, device="cpu", dt
     unet_config = create_unet_diffusers_config(v2, unet_use_linear_projection_in_v2)
     converted_unet_checkpoint = convert_ldm_unet_checkpoint(v2, state_dict, unet_config)
 
-    unet = UNet2DConditionModel(**unet_config).to(device)
-    info = unet.load_state_dict(converted_unet_checkpoint)
+    # instantiate on the meta device and stream the checkpoint tensors in one by one:
+    # this skips the random init and avoids holding model weights and checkpoint at once
+    with init_empty_weights():
+        unet = UNet2DConditionModel(**unet_config)
+    info = load_state_dict_on_device(unet, converted_unet_checkpoint, device)
     logger.info(f"loading u-net: {info}")
 
     # Convert the VAE model.
     vae_config = create_vae_diffusers_config()
     converted_vae_checkpoint = convert_ldm_vae_checkpoint(state_dict, vae_config)
 
-    vae = AutoencoderKL(**vae_config).to(device)
-    info = vae.load_state_dict(converted_vae_checkpoint)
+    with init_empty_weights():
+        vae = AutoencoderKL(**vae_config)
+    info = load_state_dict_on_device(vae, converted_vae_checkpoint, device)
     logger.info(f"loading vae: {info}")
 
     # convert text_model
@@ -1184,7 +1243,9 @@ def save_stable_diffusion_checkpoint(
             key = prefix + k
             assert not strict or key in state_dict, f"Illegal key in save SD: {key}"
             if save_dtype is not None:
-                v = v.detach().clone().to("cpu").to(save_dtype)
+                # single fused copy: clone().to("cpu").to(dtype) materializes the tensor
+                # three times (device clone, fp32 CPU copy, cast copy)
+                v = v.detach().to("cpu", dtype=save_dtype, copy=True)
             state_dict[key] = v
 
     # Convert the UNet model
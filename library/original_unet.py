@@ -112,7 +112,6 @@ from typing import Dict, Optional, Tuple, Union
 import torch
 from torch import nn
 from torch.nn import functional as F
-from einops import rearrange
 from library.utils import setup_logging
 setup_logging()
 import logging
@@ -181,7 +180,7 @@ class FlashAttentionFunction(torch.autograd.Function):
         if not exists(mask):
             mask = (None,) * math.ceil(q.shape[-2] / q_bucket_size)
         else:
-            mask = rearrange(mask, "b n -> b 1 1 n")
+            mask = mask.unsqueeze(1).unsqueeze(1)  # b n -> b 1 1 n
             mask = mask.split(q_bucket_size, dim=-1)
 
         row_splits = zip(
@@ -694,15 +693,12 @@ class CrossAttention(nn.Module):
         k_in = self.to_k(context)
         v_in = self.to_v(context)
 
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b n h d", h=h), (q_in, k_in, v_in))
+        q, k, v = map(lambda t: t.view(t.shape[0], t.shape[1], h, -1), (q_in, k_in, v_in))
         del q_in, k_in, v_in
 
-        q = q.contiguous()
-        k = k.contiguous()
-        v = v.contiguous()
         out = xformers.ops.memory_efficient_attention(q, k, v, attn_bias=None)  # 最適なのを選んでくれる
 
-        out = rearrange(out, "b n h d -> b n (h d)", h=h)
+        out = out.reshape(out.shape[0], out.shape[1], -1)
 
         out = self.to_out[0](out)
         return out
@@ -721,11 +717,11 @@ class CrossAttention(nn.Module):
         v = self.to_v(context)
         del context, x
 
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q, k, v))
+        q, k, v = map(lambda t: t.view(t.shape[0], t.shape[1], h, -1).transpose(1, 2), (q, k, v))
 
         out = flash_func.apply(q, k, v, mask, False, q_bucket_size, k_bucket_size)
 
-        out = rearrange(out, "b h n d -> b n (h d)")
+        out = out.transpose(1, 2).reshape(out.shape[0], out.shape[2], -1)
 
         out = self.to_out[0](out)
         return out
@@ -738,12 +734,12 @@ class CrossAttention(nn.Module):
         k_in = self.to_k(context)
         v_in = self.to_v(context)
 
-        q, k, v = map(lambda t: rearrange(t, "b n (h d) -> b h n d", h=h), (q_in, k_in, v_in))
+        q, k, v = map(lambda t: t.view(t.shape[0], t.shape[1], h, -1).transpose(1, 2), (q_in, k_in, v_in))
         del q_in, k_in, v_in
 
         out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=0.0, is_causal=False)
 
-        out = rearrange(out, "b h n d -> b n (h d)", h=h)
+        out = out.transpose(1, 2).reshape(out.shape[0], out.shape[2], -1)
 
         out = self.to_out[0](out)
         return out
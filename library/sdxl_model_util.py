@@ -1,9 +1,11 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 from accelerate import init_empty_weights
-from accelerate.utils.modeling import set_module_tensor_to_device
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 from transformers import CLIPTextModel, CLIPTextConfig, CLIPTextModelWithProjection, CLIPTokenizer
-from typing import List
 from diffusers import AutoencoderKL, EulerDiscreteScheduler, UNet2DConditionModel
 from library import model_util
 from library import sdxl_original_unet
@@ -67,6 +69,54 @@ DIFFUSERS_SDXL_UNET_CONFIG = {
 }
 
 
+# Text Encoder 1 is same to Stability AI's SDXL
+TEXT_ENCODER1_CONFIG = CLIPTextConfig(
+    vocab_size=49408,
+    hidden_size=768,
+    intermediate_size=3072,
+    num_hidden_layers=12,
+    num_attention_heads=12,
+    max_position_embeddings=77,
+    hidden_act="quick_gelu",
+    layer_norm_eps=1e-05,
+    dropout=0.0,
+    attention_dropout=0.0,
+    initializer_range=0.02,
+    initializer_factor=1.0,
+    pad_token_id=1,
+    bos_token_id=0,
+    eos_token_id=2,
+    model_type="clip_text_model",
+    projection_dim=768,
+    # torch_dtype="float32",
+    # transformers_version="4.25.0.dev0",
+)
+
+# Text Encoder 2 is different from Stability AI's SDXL. SDXL uses open clip, but we use the model from HuggingFace.
+# Note: Tokenizer from HuggingFace is different from SDXL. We must use open clip's tokenizer.
+TEXT_ENCODER2_CONFIG = CLIPTextConfig(
+    vocab_size=49408,
+    hidden_size=1280,
+    intermediate_size=5120,
+    num_hidden_layers=32,
+    num_attention_heads=20,
+    max_position_embeddings=77,
+    hidden_act="gelu",
+    layer_norm_eps=1e-05,
+    dropout=0.0,
+    attention_dropout=0.0,
+    initializer_range=0.02,
+    initializer_factor=1.0,
+    pad_token_id=1,
+    bos_token_id=0,
+    eos_token_id=2,
+    model_type="clip_text_model",
+    projection_dim=1280,
+    # torch_dtype="float32",
+    # transformers_version="4.25.0.dev0",
+)
+
+
 def convert_sdxl_text_encoder_2_checkpoint(checkpoint, max_length):
     SDXL_KEY_PREFIX = "conditioner.embedders.1.model."
 
@@ -141,26 +191,33 @@ def convert_sdxl_text_encoder_2_checkpoint(checkpoint, max_length):
     return new_sd, logit_scale
 
 
-# load state_dict without allocating new tensors
-def _load_state_dict_on_device(model, state_dict, device, dtype=None):
-    # dtype will use fp32 as default
-    missing_keys = list(model.state_dict().keys() - state_dict.keys())
-    unexpected_keys = list(state_dict.keys() - model.state_dict().keys())
+def _load_safetensors_parallel(ckpt_path, num_workers=None):
+    # the safetensors header gives exact per-tensor offsets, so the (I/O bound) tensor reads can
+    # run concurrently. each worker opens its own handle, handles are not shared across threads
+    with safe_open(ckpt_path, framework="pt", device="cpu") as f:
+        keys = list(f.keys())
 
-    # similar to model.load_state_dict()
-    if not missing_keys and not unexpected_keys:
-        for k in list(state_dict.keys()):
-            set_module_tensor_to_device(model, k, device, value=state_dict.pop(k), dtype=dtype)
-        return "<All keys matched successfully>"
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    if num_workers <= 1 or len(keys) < num_workers:
+        return load_file(ckpt_path)
 
-    # error_msgs
-    error_msgs: List[str] = []
-    if missing_keys:
-        error_msgs.insert(0, "Missing key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in missing_keys)))
-    if unexpected_keys:
-        error_msgs.insert(0, "Unexpected key(s) in state_dict: {}. ".format(", ".join('"{}"'.format(k) for k in unexpected_keys)))
+    def load_shard(shard_keys):
+        shard = {}
+        with safe_open(ckpt_path, framework="pt", device="cpu") as f:
+            for k in shard_keys:
+                shard[k] = f.get_tensor(k)
+        return shard
+
+    state_dict = {}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for shard in executor.map(load_shard, [keys[i::num_workers] for i in range(num_workers)]):
+            state_dict.update(shard)
+    return state_dict
 
-    raise RuntimeError("Error(s) in loading state_dict for {}:\n\t{}".format(model.__class__.__name__, "\n\t".join(error_msgs)))
+
+# moved to model_util so the SD1/SD2 loader can share it
+_load_state_dict_on_device = model_util.load_state_dict_on_device
 
 
 def load_models_from_sdxl_checkpoint(model_version, ckpt_path, map_location, dtype=None):
@@ -168,101 +225,73 @@ def load_models_from_sdxl_checkpoint(model_version, ckpt_path, map_location, dty
     # dtype is used for full_fp16/bf16 integration. Text Encoder will remain fp32, because it runs on CPU when caching
 
     # Load the state dict
-    if model_util.is_safetensors(ckpt_path):
+    def read_state_dict():
+        if model_util.is_safetensors(ckpt_path):
+            # load to CPU even if the target is CUDA: copying from the mmap'ed file directly to the
+            # device pages the file in 4KB at a time and is much slower than CPU load + async copy
+            return _load_safetensors_parallel(ckpt_path), None, None
+
         checkpoint = None
-        try:
-            state_dict = load_file(ckpt_path, device=map_location)
-        except:
-            state_dict = load_file(ckpt_path)  # prevent device invalid Error
-        epoch = None
-        global_step = None
-    else:
-        checkpoint = torch.load(ckpt_path, map_location=map_location)
+        if map_location is None or torch.device(map_location).type == "cpu":
+            try:
+                # mmap=True (PyTorch 2.1+) maps the file instead of materializing a full CPU copy,
+                # so peak host RAM stays at one tensor instead of the whole checkpoint
+                checkpoint = torch.load(ckpt_path, map_location=map_location, mmap=True)
+            except (TypeError, RuntimeError):
+                checkpoint = None  # old PyTorch or legacy (non-zipfile) checkpoint
+        if checkpoint is None:
+            checkpoint = torch.load(ckpt_path, map_location=map_location)
         if "state_dict" in checkpoint:
-            state_dict = checkpoint["state_dict"]
-            epoch = checkpoint.get("epoch", 0)
-            global_step = checkpoint.get("global_step", 0)
-        else:
-            state_dict = checkpoint
-            epoch = 0
-            global_step = 0
-        checkpoint = None
+            return checkpoint["state_dict"], checkpoint.get("epoch", 0), checkpoint.get("global_step", 0)
+        return checkpoint, 0, 0
+
+    # the checkpoint read is I/O bound and the meta-device skeleton builds allocate no tensors,
+    # so run the read in a worker thread and build the models while it is in flight
+    executor = ThreadPoolExecutor(max_workers=1)
+    state_dict_future = executor.submit(read_state_dict)
 
     # U-Net
     logger.info("building U-Net")
     with init_empty_weights():
         unet = sdxl_original_unet.SdxlUNet2DConditionModel()
 
-    logger.info("loading U-Net from checkpoint")
-    unet_sd = {}
-    for k in list(state_dict.keys()):
-        if k.startswith("model.diffusion_model."):
-            unet_sd[k.replace("model.diffusion_model.", "")] = state_dict.pop(k)
-    info = _load_state_dict_on_device(unet, unet_sd, device=map_location, dtype=dtype)
-    logger.info(f"U-Net: {info}")
-
     # Text Encoders
     logger.info("building text encoders")
 
-    # Text Encoder 1 is same to Stability AI's SDXL
-    text_model1_cfg = CLIPTextConfig(
-        vocab_size=49408,
-        hidden_size=768,
-        intermediate_size=3072,
-        num_hidden_layers=12,
-        num_attention_heads=12,
-        max_position_embeddings=77,
-        hidden_act="quick_gelu",
-        layer_norm_eps=1e-05,
-        dropout=0.0,
-        attention_dropout=0.0,
-        initializer_range=0.02,
-        initializer_factor=1.0,
-        pad_token_id=1,
-        bos_token_id=0,
-        eos_token_id=2,
-        model_type="clip_text_model",
-        projection_dim=768,
-        # torch_dtype="float32",
-        # transformers_version="4.25.0.dev0",
-    )
+    # configs are built once at import time (TEXT_ENCODER1_CONFIG / TEXT_ENCODER2_CONFIG)
     with init_empty_weights():
-        text_model1 = CLIPTextModel._from_config(text_model1_cfg)
-
-    # Text Encoder 2 is different from Stability AI's SDXL. SDXL uses open clip, but we use the model from HuggingFace.
-    # Note: Tokenizer from HuggingFace is different from SDXL. We must use open clip's tokenizer.
-    text_model2_cfg = CLIPTextConfig(
-        vocab_size=49408,
-        hidden_size=1280,
-        intermediate_size=5120,
-        num_hidden_layers=32,
-        num_attention_heads=20,
-        max_position_embeddings=77,
-        hidden_act="gelu",
-        layer_norm_eps=1e-05,
-        dropout=0.0,
-        attention_dropout=0.0,
-        initializer_range=0.02,
-        initializer_factor=1.0,
-        pad_token_id=1,
-        bos_token_id=0,
-        eos_token_id=2,
-        model_type="clip_text_model",
-        projection_dim=1280,
-        # torch_dtype="float32",
-        # transformers_version="4.25.0.dev0",
-    )
+        text_model1 = CLIPTextModel._from_config(TEXT_ENCODER1_CONFIG)
+
     with init_empty_weights():
-        text_model2 = CLIPTextModelWithProjection(text_model2_cfg)
+        text_model2 = CLIPTextModelWithProjection(TEXT_ENCODER2_CONFIG)
 
-    logger.info("loading text encoders from checkpoint")
+    state_dict, epoch, global_step = state_dict_future.result()
+    executor.shutdown(wait=False)
+
+    logger.info("loading U-Net from checkpoint")
+
+    # partition the checkpoint in a single pass instead of rescanning (and popping from) the
+    # full key set once per component
+    unet_sd = {}
     te1_sd = {}
     te2_sd = {}
-    for k in list(state_dict.keys()):
-        if k.startswith("conditioner.embedders.0.transformer."):
-            te1_sd[k.replace("conditioner.embedders.0.transformer.", "")] = state_dict.pop(k)
+    other_sd = {}
+    for k, v in state_dict.items():
+        if k.startswith("model.diffusion_model."):
+            unet_sd[k[len("model.diffusion_model.") :]] = v
+        elif k.startswith("conditioner.embedders.0.transformer."):
+            te1_sd[k[len("conditioner.embedders.0.transformer.") :]] = v
         elif k.startswith("conditioner.embedders.1.model."):
-            te2_sd[k] = state_dict.pop(k)
+            te2_sd[k] = v
+        else:
+            other_sd[k] = v
+    state_dict = other_sd
+
+    info = _load_state_dict_on_device(unet, unet_sd, device=map_location, dtype=dtype)
+    logger.info(f"U-Net: {info}")
+
+    # Text Encoders
+    logger.info("loading text encoders from checkpoint")
 
     # 最新の transformers では position_ids を含むとエラーになるので削除 / remove position_ids for latest transformers
     if "text_model.embeddings.position_ids" in te1_sd:
@@ -489,7 +518,9 @@ def save_stable_diffusion_checkpoint(
         for k, v in sd.items():
             key = prefix + k
             if save_dtype is not None:
-                v = v.detach().clone().to("cpu").to(save_dtype)
+                # single fused copy: clone().to("cpu").to(dtype) materializes the tensor
+                # three times (device clone, fp32 CPU copy, cast copy)
+                v = v.detach().to("cpu", dtype=save_dtype, copy=True)
             state_dict[key] = v
 
     # Convert the UNet model
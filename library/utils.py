@@ -30,6 +30,31 @@ def add_logging_arguments(parser):
     parser.add_argument("--console_log_simple", action="store_true", help="Simple log output / シンプルなログ出力")
 
 
+class _LazyConsoleHandler(logging.Handler):
+    # stands in for the console handler until a record is actually emitted, so
+    # processes that never log (spawned DataLoader workers, DDP ranks before the
+    # entry script reconfigures logging) skip the rich import and console setup
+    def _make_handler(self):
+        try:
+            from rich.logging import RichHandler
+            from rich.console import Console
+
+            return RichHandler(console=Console(stderr=True))
+        except ImportError:
+            handler = logging.StreamHandler(sys.stdout)  # same as print
+            handler.propagate = False
+            return handler
+
+    def emit(self, record):
+        handler = self._make_handler()
+        if self.formatter is not None:
+            handler.setFormatter(self.formatter)
+        if self in logging.root.handlers:
+            logging.root.removeHandler(self)
+            logging.root.addHandler(handler)
+        handler.handle(record)
+
+
 def setup_logging(args=None, log_level=None, reset=False):
     if logging.root.handlers:
         if reset:
@@ -49,13 +74,15 @@ def setup_logging(args=None, log_level=None, reset=False):
     msg_init = None
     if args is not None and args.console_log_file:
         handler = logging.FileHandler(args.console_log_file, mode="w")
+    elif args is None:
+        # import-time fallback path (no args): defer the real handler construction
+        handler = _LazyConsoleHandler()
     else:
         handler = None
-        if not args or not args.console_log_simple:
+        if not args.console_log_simple:
             try:
                 from rich.logging import RichHandler
                 from rich.console import Console
-                from rich.logging import RichHandler
 
                 handler = RichHandler(console=Console(stderr=True))
             except ImportError:
@@ -5,6 +5,8 @@
 
 import math
 import os
+import pickle
+import random
 from typing import Dict, List, Optional, Tuple, Type, Union
 from diffusers import AutoencoderKL
 from transformers import CLIPTextModel
@@ -55,15 +57,18 @@ class LoRAModule(torch.nn.Module):
         # else:
         self.lora_dim = lora_dim
 
+        # skip_init builds the submodules on the meta device and materializes them without
+        # running the default reset_parameters, which the kaiming/zeros init below would
+        # overwrite anyway; this halves the init work over hundreds of modules
         if org_module.__class__.__name__ == "Conv2d":
             kernel_size = org_module.kernel_size
             stride = org_module.stride
             padding = org_module.padding
-            self.lora_down = torch.nn.Conv2d(in_dim, self.lora_dim, kernel_size, stride, padding, bias=False)
-            self.lora_up = torch.nn.Conv2d(self.lora_dim, out_dim, (1, 1), (1, 1), bias=False)
+            self.lora_down = torch.nn.utils.skip_init(torch.nn.Conv2d, in_dim, self.lora_dim, kernel_size, stride, padding, bias=False)
+            self.lora_up = torch.nn.utils.skip_init(torch.nn.Conv2d, self.lora_dim, out_dim, (1, 1), (1, 1), bias=False)
         else:
-            self.lora_down = torch.nn.Linear(in_dim, self.lora_dim, bias=False)
-            self.lora_up = torch.nn.Linear(self.lora_dim, out_dim, bias=False)
+            self.lora_down = torch.nn.utils.skip_init(torch.nn.Linear, in_dim, self.lora_dim, bias=False)
+            self.lora_up = torch.nn.utils.skip_init(torch.nn.Linear, self.lora_dim, out_dim, bias=False)
 
         if type(alpha) == torch.Tensor:
             alpha = alpha.detach().float().numpy()  # without casting, bf16 causes error
@@ -81,20 +86,37 @@ class LoRAModule(torch.nn.Module):
         self.rank_dropout = rank_dropout
         self.module_dropout = module_dropout
 
+        # dropoutの設定はこの後変わらないので、ここでforwardを選んでおく(毎回の分岐を避ける)
+        # subclasses (LoRAInfModule) override forward for their own dispatch, so leave them alone
+        if type(self).forward is LoRAModule.forward and dropout is None and rank_dropout is None and module_dropout is None:
+            self.forward = self._forward_no_dropout
+
     def apply_to(self):
         self.org_forward = self.org_module.forward
         self.org_module.forward = self.forward
         del self.org_module
 
+    def _forward_no_dropout(self, x):
+        # straight-line hot path: no dropout of any kind is configured for this module
+        if self.multiplier == 0.0:
+            return self.org_forward(x)
+        return torch.add(self.org_forward(x), self.lora_up.forward(self.lora_down.forward(x)), alpha=self.multiplier * self.scale)
+
     def forward(self, x):
         org_forwarded = self.org_forward(x)
 
+        # multiplier 0 means no contribution: skip both LoRA GEMMs
+        if self.multiplier == 0.0:
+            return org_forwarded
+
         # module dropout
         if self.module_dropout is not None and self.training:
-            if torch.rand(1) < self.module_dropout:
+            # host-side RNG: torch.rand(1) allocates a tensor and the bool() conversion
+            # syncs with the device when a default CUDA device is set
+            if random.random() < self.module_dropout:
                 return org_forwarded
 
-        lx = self.lora_down(x)
+        lx = self.lora_down.forward(x)
 
         # normal dropout
         if self.dropout is not None and self.training:
@@ -102,12 +124,13 @@ class LoRAModule(torch.nn.Module):
 
         # rank dropout
         if self.rank_dropout is not None and self.training:
-            mask = torch.rand((lx.size(0), self.lora_dim), device=lx.device) > self.rank_dropout
+            # drop mask as bool + in-place fill: one RNG kernel and no float mask the size of lx
+            mask = torch.empty((lx.size(0), self.lora_dim), dtype=torch.bool, device=lx.device).bernoulli_(self.rank_dropout)
             if len(lx.size()) == 3:
                 mask = mask.unsqueeze(1)  # for Text Encoder
             elif len(lx.size()) == 4:
                 mask = mask.unsqueeze(-1).unsqueeze(-1)  # for Conv2d
-            lx = lx * mask
+            lx = lx.masked_fill_(mask, 0.0)
 
             # scaling for rank dropout: treat as if the rank is changed
             # maskから計算することも考えられるが、augmentation的な効果を期待してrank_dropoutを用いる
@@ -115,9 +138,10 @@ class LoRAModule(torch.nn.Module):
         else:
             scale = self.scale
 
-        lx = self.lora_up(lx)
+        lx = self.lora_up.forward(lx)
 
-        return org_forwarded + lx * self.multiplier * scale
+        # fused multiply-add: lx * multiplier * scale materializes two intermediates
+        return torch.add(org_forwarded, lx, alpha=self.multiplier * scale)
 
 
 class LoRAInfModule(LoRAModule):
@@ -135,6 +159,7 @@ class LoRAInfModule(LoRAModule):
 
         self.org_module_ref = [org_module]  # 後から参照できるように
         self.enabled = True
+        self.forward_bypassed = False  # True while pre_calculation has unhooked this module's forward
 
         # check regional or not by lora_name
         self.text_encoder = False
@@ -222,7 +247,10 @@ class LoRAInfModule(LoRAModule):
 
     def default_forward(self, x):
         # logger.info(f"default_forward {self.lora_name} {x.size()}")
-        return self.org_forward(x) + self.lora_up(self.lora_down(x)) * self.multiplier * self.scale
+        if self.multiplier == 0.0:
+            return self.org_forward(x)
+        # single fused add, and one scalar product instead of two broadcast multiplies
+        return torch.add(self.org_forward(x), self.lora_up.forward(self.lora_down.forward(x)), alpha=self.multiplier * self.scale)
 
     def forward(self, x):
         if not self.enabled:
@@ -265,8 +293,9 @@ class LoRAInfModule(LoRAModule):
             return self.default_forward(x)
 
         # apply mask for LoRA result
-        lx = self.lora_up(self.lora_down(x)) * self.multiplier * self.scale
-        mask = self.get_mask_for_x(lx)
+        # scale the (broadcast-sized) mask instead of lx: the mask is much smaller
+        lx = self.lora_up.forward(self.lora_down.forward(x))
+        mask = self.get_mask_for_x(lx) * (self.multiplier * self.scale)
         # print("regional", self.lora_name, self.network.sub_prompt_index, lx.size(), mask.size())
         # if mask.ndim > lx.ndim:  # in some resolution, lx is 2d and mask is 3d (the reason is not checked)
         #     mask = mask.squeeze(-1)
@@ -311,7 +340,7 @@ class LoRAInfModule(LoRAModule):
 
         # apply sub prompt of X
         lx = x[emb_idx :: self.network.num_sub_prompts]
-        lx = self.lora_up(self.lora_down(lx)) * self.multiplier * self.scale
+        lx = self.lora_up.forward(self.lora_down.forward(lx)) * (self.multiplier * self.scale)
 
         # logger.info(f"sub_prompt_forward {self.lora_name} {x.size()} {lx.size()} {emb_idx}")
 
@@ -331,7 +360,7 @@ class LoRAInfModule(LoRAModule):
 
         # call own LoRA
         x1 = x[self.network.batch_size + self.network.sub_prompt_index :: self.network.num_sub_prompts]
-        lx1 = self.lora_up(self.lora_down(x1)) * self.multiplier * self.scale
+        lx1 = self.lora_up.forward(self.lora_down.forward(x1)) * (self.multiplier * self.scale)
 
         if self.network.is_last_network:
             lx = torch.zeros(
@@ -471,6 +500,11 @@ def create_network(
     if module_dropout is not None:
         module_dropout = float(module_dropout)
 
+    # torch.compileでLoRAのforwardを融合する
+    compile_loras = kwargs.get("compile_loras", False)
+    if isinstance(compile_loras, str):
+        compile_loras = compile_loras == "True"
+
     # すごく引数が多いな ( ^ω^)･･･
     network = LoRANetwork(
         text_encoder,
@@ -493,6 +527,9 @@ def create_network(
     if up_lr_weight is not None or mid_lr_weight is not None or down_lr_weight is not None:
         network.set_block_lr_weight(up_lr_weight, mid_lr_weight, down_lr_weight)
 
+    if compile_loras:
+        network.compile_loras()
+
     return network
 
 
@@ -705,19 +742,23 @@ def create_network_from_weights(multiplier, file, vae, text_encoder, unet, weigh
 
             weights_sd = load_file(file)
         else:
-            weights_sd = torch.load(file, map_location="cpu")
+            try:
+                weights_sd = torch.load(file, map_location="cpu", mmap=True, weights_only=True)
+            except (TypeError, RuntimeError, pickle.UnpicklingError):  # old PyTorch, legacy format or non-tensor entries
+                weights_sd = torch.load(file, map_location="cpu")
 
     # get dim/alpha mapping
     modules_dim = {}
     modules_alpha = {}
     for key, value in weights_sd.items():
-        if "." not in key:
+        # partition splits on the first "." only, without building a list for every key
+        lora_name, sep, rest = key.partition(".")
+        if not sep:
             continue
 
-        lora_name = key.split(".")[0]
-        if "alpha" in key:
+        if rest == "alpha":
             modules_alpha[lora_name] = value
-        elif "lora_down" in key:
+        elif rest == "lora_down.weight":
             dim = value.size()[0]
             modules_dim[lora_name] = dim
             # logger.info(lora_name, value.size(), dim)
@@ -834,60 +875,76 @@ class LoRANetwork(torch.nn.Module):
             )
             loras = []
             skipped = []
-            for name, module in root_module.named_modules():
-                if module.__class__.__name__ in target_replace_modules:
-                    for child_name, child_module in module.named_modules():
-                        is_linear = child_module.__class__.__name__ == "Linear"
-                        is_conv2d = child_module.__class__.__name__ == "Conv2d"
-                        is_conv2d_1x1 = is_conv2d and child_module.kernel_size == (1, 1)
-
-                        if is_linear or is_conv2d:
-                            lora_name = prefix + "." + name + "." + child_name
-                            lora_name = lora_name.replace(".", "_")
-
-                            dim = None
-                            alpha = None
-
-                            if modules_dim is not None:
-                                # モジュール指定あり
-                                if lora_name in modules_dim:
-                                    dim = modules_dim[lora_name]
-                                    alpha = modules_alpha[lora_name]
-                            elif is_unet and block_dims is not None:
-                                # U-Netでblock_dims指定あり
-                                block_idx = get_block_index(lora_name)
-                                if is_linear or is_conv2d_1x1:
-                                    dim = block_dims[block_idx]
-                                    alpha = block_alphas[block_idx]
-                                elif conv_block_dims is not None:
-                                    dim = conv_block_dims[block_idx]
-                                    alpha = conv_block_alphas[block_idx]
-                            else:
-                                # 通常、すべて対象とする
-                                if is_linear or is_conv2d_1x1:
-                                    dim = self.lora_dim
-                                    alpha = self.alpha
-                                elif self.conv_lora_dim is not None:
-                                    dim = self.conv_lora_dim
-                                    alpha = self.conv_alpha
-
-                            if dim is None or dim == 0:
-                                # skipした情報を出力
-                                if is_linear or is_conv2d_1x1 or (self.conv_lora_dim is not None or conv_block_dims is not None):
-                                    skipped.append(lora_name)
-                                continue
-
-                            lora = module_class(
-                                lora_name,
-                                child_module,
-                                self.multiplier,
-                                dim,
-                                alpha,
-                                dropout=dropout,
-                                rank_dropout=rank_dropout,
-                                module_dropout=module_dropout,
-                            )
-                            loras.append(lora)
+            target_set = frozenset(target_replace_modules)
+            is_target_cls = {}  # class -> bool, resolve the name comparison once per class instead of per node
+            # named_modules yields in pre-order, so all descendants of a target block follow
+            # it directly with its name as prefix; tracking that prefix in a single walk
+            # replaces the nested re-walk of every target block
+            enclosing_prefix = None
+            for name, child_module in root_module.named_modules():
+                cls = child_module.__class__
+                if enclosing_prefix is not None and not name.startswith(enclosing_prefix):
+                    enclosing_prefix = None
+                if enclosing_prefix is None:
+                    hit = is_target_cls.get(cls)
+                    if hit is None:
+                        hit = is_target_cls[cls] = cls.__name__ in target_set
+                    if hit:
+                        enclosing_prefix = name + "."
+                    continue
+
+                # the original name checks were exact ("Linear", not subclasses), so identity is equivalent
+                is_linear = cls is torch.nn.Linear
+                is_conv2d = cls is torch.nn.Conv2d
+                is_conv2d_1x1 = is_conv2d and child_module.kernel_size == (1, 1)
+
+                if is_linear or is_conv2d:
+                    lora_name = prefix + "." + name
+                    lora_name = lora_name.replace(".", "_")
+
+                    dim = None
+                    alpha = None
+
+                    if modules_dim is not None:
+                        # モジュール指定あり
+                        if lora_name in modules_dim:
+                            dim = modules_dim[lora_name]
+                            alpha = modules_alpha[lora_name]
+                    elif is_unet and block_dims is not None:
+                        # U-Netでblock_dims指定あり
+                        block_idx = get_block_index(lora_name)
+                        if is_linear or is_conv2d_1x1:
+                            dim = block_dims[block_idx]
+                            alpha = block_alphas[block_idx]
+                        elif conv_block_dims is not None:
+                            dim = conv_block_dims[block_idx]
+                            alpha = conv_block_alphas[block_idx]
+                    else:
+                        # 通常、すべて対象とする
+                        if is_linear or is_conv2d_1x1:
+                            dim = self.lora_dim
+                            alpha = self.alpha
+                        elif self.conv_lora_dim is not None:
+                            dim = self.conv_lora_dim
+                            alpha = self.conv_alpha
+
+                    if dim is None or dim == 0:
+                        # skipした情報を出力
+                        if is_linear or is_conv2d_1x1 or (self.conv_lora_dim is not None or conv_block_dims is not None):
+                            skipped.append(lora_name)
+                        continue
+
+                    lora = module_class(
+                        lora_name,
+                        child_module,
+                        self.multiplier,
+                        dim,
+                        alpha,
+                        dropout=dropout,
+                        rank_dropout=rank_dropout,
+                        module_dropout=module_dropout,
+                    )
+                    loras.append(lora)
             return loras, skipped
 
         text_encoders = text_encoder if type(text_encoder) == list else [text_encoder]
@@ -929,6 +986,7 @@ class LoRANetwork(torch.nn.Module):
         self.down_lr_weight: List[float] = None
         self.mid_lr_weight: float = None
         self.block_lr = False
+        self._requires_grad_set = False  # requires_grad_(True)は一度だけでよい
 
         # assertion
         names = set()
@@ -951,7 +1009,11 @@ class LoRANetwork(torch.nn.Module):
 
             weights_sd = load_file(file)
         else:
-            weights_sd = torch.load(file, map_location="cpu")
+            try:
+                # mmap=True (PyTorch 2.1+) avoids deserializing the whole file into RAM
+                weights_sd = torch.load(file, map_location="cpu", mmap=True, weights_only=True)
+            except (TypeError, RuntimeError, pickle.UnpicklingError):  # old PyTorch, legacy format or non-tensor entries
+                weights_sd = torch.load(file, map_location="cpu")
 
         info = self.load_state_dict(weights_sd, False)
         return info
@@ -967,9 +1029,23 @@ class LoRANetwork(torch.nn.Module):
         else:
             self.unet_loras = []
 
+        # add_module re-validates name and type on every call; lora_name is always a
+        # dot-free identifier (create_modules replaces "." with "_"), so register by
+        # writing _modules directly, which is all add_module does after its checks
+        modules = self._modules
         for lora in self.text_encoder_loras + self.unet_loras:
             lora.apply_to()
-            self.add_module(lora.lora_name, lora)
+            modules[lora.lora_name] = lora
+
+    def compile_loras(self):
+        # torch.compileでLoRAのforward(小さなGEMM+add)を1-2カーネルに融合する
+        # apply_to()がorg_module.forwardへself.forwardを差し込むため、先に呼ぶこと
+        if not hasattr(torch, "compile"):
+            logger.warning("torch.compile is not available, skip compiling LoRA modules")
+            return
+        logger.info("compile LoRA modules with torch.compile")
+        for lora in self.text_encoder_loras + self.unet_loras:
+            lora.forward = torch.compile(lora.forward, mode="reduce-overhead", dynamic=False, fullgraph=False)
 
     # マージできるかどうかを返す
     def is_mergeable(self):
@@ -977,12 +1053,17 @@ class LoRANetwork(torch.nn.Module):
 
     # TODO refactor to common function with apply_to
     def merge_to(self, text_encoder, unet, weights_sd, dtype, device):
+        # both flags are usually set within the first few keys; stop scanning once they are
+        te_prefix = LoRANetwork.LORA_PREFIX_TEXT_ENCODER
+        unet_prefix = LoRANetwork.LORA_PREFIX_UNET
         apply_text_encoder = apply_unet = False
         for key in weights_sd.keys():
-            if key.startswith(LoRANetwork.LORA_PREFIX_TEXT_ENCODER):
+            if not apply_text_encoder and key.startswith(te_prefix):
                 apply_text_encoder = True
-            elif key.startswith(LoRANetwork.LORA_PREFIX_UNET):
+            elif not apply_unet and key.startswith(unet_prefix):
                 apply_unet = True
+            if apply_text_encoder and apply_unet:
+                break
 
         if apply_text_encoder:
             logger.info("enable LoRA for text encoder")
@@ -994,12 +1075,17 @@ class LoRANetwork(torch.nn.Module):
         else:
             self.unet_loras = []
 
+        # group the flat key space once (lora_name -> {suffix: tensor}) instead of
+        # rescanning every key per module, which is O(num_loras * num_keys)
+        grouped_sd = {}
+        for key, value in weights_sd.items():
+            for suffix in (".lora_down.weight", ".lora_up.weight", ".alpha"):
+                if key.endswith(suffix):
+                    grouped_sd.setdefault(key[: -len(suffix)], {})[suffix[1:]] = value
+                    break
+
         for lora in self.text_encoder_loras + self.unet_loras:
-            sd_for_lora = {}
-            for key in weights_sd.keys():
-                if key.startswith(lora.lora_name):
-                    sd_for_lora[key[len(lora.lora_name) + 1 :]] = weights_sd[key]
-            lora.merge_to(sd_for_lora, dtype, device)
+            lora.merge_to(grouped_sd.get(lora.lora_name, {}), dtype, device)
 
         logger.info(f"weights are merged")
 
@@ -1034,8 +1120,15 @@ class LoRANetwork(torch.nn.Module):
         return lr_weight
 
     # 二つのText Encoderに別々の学習率を設定できるようにするといいかも
+    def _set_requires_grad(self):
+        # walking every parameter is O(N); both optimizer-setup entry points call this,
+        # so flip the flags only once
+        if not self._requires_grad_set:
+            self.requires_grad_(True)
+            self._requires_grad_set = True
+
     def prepare_optimizer_params(self, text_encoder_lr, unet_lr, default_lr):
-        self.requires_grad_(True)
+        self._set_requires_grad()
         all_params = []
 
         def enumerate_params(loras):
@@ -1085,7 +1178,7 @@ class LoRANetwork(torch.nn.Module):
         pass
 
     def prepare_grad_etc(self, text_encoder, unet):
-        self.requires_grad_(True)
+        self._set_requires_grad()
 
     def on_epoch_start(self, text_encoder, unet):
         self.train()
@@ -1100,13 +1193,29 @@ class LoRANetwork(torch.nn.Module):
         state_dict = self.state_dict()
 
         if dtype is not None:
-            for key in list(state_dict.keys()):
-                v = state_dict[key]
-                v = v.detach().clone().to("cpu").to(dtype)
-                state_dict[key] = v
+            # stage device tensors through pinned buffers with non-blocking copies so the
+            # D2H transfers queue back-to-back instead of each one blocking the Python loop,
+            # then synchronize once before serialization; CPU tensors just get the fused cast
+            staged = {}
+            needs_sync = False
+            for key, v in state_dict.items():
+                v = v.detach()
+                if v.device.type == "cpu":
+                    staged[key] = v if v.dtype == dtype else v.to(dtype, copy=True)
+                elif v.device.type == "cuda":
+                    buf = torch.empty(v.shape, dtype=dtype, pin_memory=True)
+                    buf.copy_(v, non_blocking=True)
+                    staged[key] = buf
+                    needs_sync = True
+                else:
+                    # MPS/XPU etc.: no pinned host memory, single fused transfer + cast
+                    staged[key] = v.to("cpu", dtype=dtype, copy=True)
+            if needs_sync:
+                torch.cuda.synchronize()
+            state_dict = staged
 
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
+            import safetensors.torch
             from library import train_util
 
             # Precalculate model hashes to save time on indexing
@@ -1116,7 +1225,11 @@ class LoRANetwork(torch.nn.Module):
             metadata["sshs_model_hash"] = model_hash
             metadata["sshs_legacy_hash"] = legacy_hash
 
-            save_file(state_dict, file, metadata)
+            # serialize in memory and write the whole buffer at once; save_file's
+            # incremental writes run well below disk bandwidth for adapter-sized files
+            serialized = safetensors.torch.save(state_dict, metadata)
+            with open(file, "wb") as f:
+                f.write(serialized)
         else:
             torch.save(state_dict, file)
 
@@ -1176,8 +1289,18 @@ class LoRANetwork(torch.nn.Module):
         for lora in loras:
             org_module = lora.org_module_ref[0]
             if not hasattr(org_module, "_lora_org_weight"):
-                sd = org_module.state_dict()
-                org_module._lora_org_weight = sd["weight"].detach().clone()
+                # access .weight directly: state_dict()/load_state_dict round-trips
+                # rebuild an OrderedDict and re-validate keys just to touch one tensor
+                weight = org_module.weight
+                if weight.device.type == "cuda":
+                    # keep the backup in pinned host memory instead of doubling the VRAM of
+                    # every patched layer; the copies are stream-ordered, so later weight
+                    # updates and the H2D restore see the completed transfer
+                    buf = torch.empty(weight.shape, dtype=weight.dtype, pin_memory=True)
+                    buf.copy_(weight, non_blocking=True)
+                    org_module._lora_org_weight = buf
+                else:
+                    org_module._lora_org_weight = weight.detach().clone()
                 org_module._lora_restored = True
 
     def restore_weights(self):
@@ -1185,67 +1308,118 @@ class LoRANetwork(torch.nn.Module):
         loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
         for lora in loras:
             org_module = lora.org_module_ref[0]
+            if lora.forward_bypassed:
+                # re-install the wrapper removed by pre_calculation
+                org_module.forward = lora.forward
+                lora.forward_bypassed = False
             if not org_module._lora_restored:
-                sd = org_module.state_dict()
-                sd["weight"] = org_module._lora_org_weight
-                org_module.load_state_dict(sd)
+                # copy_ keeps the Parameter object (and its device/optimizer refs) intact;
+                # the source is pinned, so the H2D transfer can run non-blocking
+                org_module.weight.data.copy_(org_module._lora_org_weight, non_blocking=True)
                 org_module._lora_restored = True
 
     def pre_calculation(self):
         # 事前計算を行う
         loras: List[LoRAInfModule] = self.text_encoder_loras + self.unet_loras
+
+        # group stacked LoRAs by their original module so each module gets one delta
+        # computation and one add_ instead of one per LoRA
+        module_to_loras = {}
         for lora in loras:
+            if lora.multiplier == 0.0:
+                # zero contribution: skip the up@down matmul entirely. enabled is not
+                # checked here: the generation scripts call restore_weights() then
+                # pre_calculation() every batch and nothing re-enables the loras, so
+                # skipping disabled ones would stop the delta from being re-merged
+                continue
             org_module = lora.org_module_ref[0]
-            sd = org_module.state_dict()
-
-            org_weight = sd["weight"]
-            lora_weight = lora.get_weight().to(org_weight.device, dtype=org_weight.dtype)
-            sd["weight"] = org_weight + lora_weight
-            assert sd["weight"].shape == org_weight.shape
-            org_module.load_state_dict(sd)
+            module_to_loras.setdefault(id(org_module), (org_module, []))[1].append(lora)
+
+        for org_module, module_loras in module_to_loras.values():
+            org_weight = org_module.weight
+            # when the base weight is 16-bit, run the delta GEMM in that dtype: the delta
+            # is rounded to it on the add_ anyway, and a fp32 up-cast just costs bandwidth
+            calc_dtype = org_weight.dtype if org_weight.dtype in (torch.float16, torch.bfloat16) else torch.float
+
+            if module_loras[0].lora_down.weight.dim() == 2 or module_loras[0].lora_down.weight.shape[2:4] == (1, 1):
+                # linear / conv2d 1x1 stack: sum_i U_i @ D_i == cat(U_i, dim=1) @ cat(D_i, dim=0),
+                # one big GEMM instead of a small one per LoRA
+                up = torch.cat(
+                    [l.lora_up.weight.flatten(1).to(calc_dtype) * (l.multiplier * l.scale) for l in module_loras], dim=1
+                )
+                down = torch.cat([l.lora_down.weight.flatten(1).to(calc_dtype) for l in module_loras], dim=0)
+                delta = (up @ down).view(org_weight.shape)
+            else:
+                # conv2d 3x3: per-LoRA conv in get_weight (fp32), but still a single add_ below
+                delta = sum(l.get_weight() for l in module_loras)
 
+            org_weight.data.add_(delta.to(org_weight.device, dtype=org_weight.dtype))
             org_module._lora_restored = False
-            lora.enabled = False
 
+            # the merged module no longer needs the LoRA wrappers; unhook from the outside
+            # in while the outermost hook belongs to this merged stack. a hook from another
+            # (unmerged) network breaks the chain and stays in place
+            for lora in reversed(module_loras):
+                lora.enabled = False
+                if org_module.forward == lora.forward:
+                    org_module.forward = lora.org_forward
+                    lora.forward_bypassed = True
+
+    @torch.no_grad()
     def apply_max_norm_regularization(self, max_norm_value, device):
-        downkeys = []
-        upkeys = []
-        alphakeys = []
-        norms = []
         keys_scaled = 0
 
-        state_dict = self.state_dict()
-        for key in state_dict.keys():
-            if "lora_down" in key and "weight" in key:
-                downkeys.append(key)
-                upkeys.append(key.replace("lora_down", "lora_up"))
-                alphakeys.append(key.replace("lora_down.weight", "alpha"))
-
-        for i in range(len(downkeys)):
-            down = state_dict[downkeys[i]].to(device)
-            up = state_dict[upkeys[i]].to(device)
-            alpha = state_dict[alphakeys[i]].to(device)
-            dim = down.shape[0]
+        # work on the live parameters directly: state_dict() rebuilds the whole dict
+        # per call just to get at .weight, and the writeback only landed because the
+        # returned tensors happen to share storage with the parameters
+        buckets = {}
+        for lora in self.text_encoder_loras + self.unet_loras:
+            shape_key = (tuple(lora.lora_down.weight.shape), tuple(lora.lora_up.weight.shape))
+            buckets.setdefault(shape_key, []).append(lora)
+
+        ordered_loras = []
+        sqrt_ratio_parts = []
+        scalednorm_parts = []
+        for bucket_loras in buckets.values():
+            down = torch.stack([lora.lora_down.weight for lora in bucket_loras]).to(device)
+            up = torch.stack([lora.lora_up.weight for lora in bucket_loras]).to(device)
+            alpha = torch.stack([lora.alpha for lora in bucket_loras]).to(device)
+            dim = down.shape[1]
             scale = alpha / dim
 
-            if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
-                updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
-            elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
-                updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
+            if down.dim() == 3:
+                # linear
+                updown = torch.bmm(up, down)
+            elif up.shape[3:] == (1, 1) and down.shape[3:] == (1, 1):
+                updown = torch.bmm(up[:, :, :, 0, 0], down[:, :, :, 0, 0])
+            elif up.shape[3:] == (1, 1):
+                # conv2d 3x3 down with pointwise up (always the case for LoRAModule):
+                # the merge is pure channel mixing, so one batched einsum replaces a
+                # conv2d launch (and its workspace) per pair
+                updown = torch.einsum("nor,nrihw->noihw", up[:, :, :, 0, 0], down)
             else:
-                updown = up @ down
+                updown = torch.stack(
+                    [torch.nn.functional.conv2d(d.permute(1, 0, 2, 3), u).permute(1, 0, 2, 3) for d, u in zip(down, up)]
+                )
+
+            # scale is a positive per-pair scalar, so norm(updown * scale) == norm(updown) * scale
+            # and the full-size elementwise multiply can be skipped
+            raw_norm = updown.flatten(1).norm(dim=1) * scale
+            norm = raw_norm.clamp(min=max_norm_value / 2)
+            ratio = torch.clamp(norm, max=max_norm_value) / norm
+
+            ordered_loras.extend(bucket_loras)
+            sqrt_ratio_parts.append(ratio.sqrt())
+            scalednorm_parts.append(raw_norm * ratio)
 
-            updown *= scale
+        # single host sync for all buckets instead of per-module .cpu()/.item()
+        sqrt_ratios = torch.cat(sqrt_ratio_parts).tolist()
+        norms = torch.cat(scalednorm_parts).tolist()
 
-            norm = updown.norm().clamp(min=max_norm_value / 2)
-            desired = torch.clamp(norm, max=max_norm_value)
-            ratio = desired.cpu() / norm.cpu()
-            sqrt_ratio = ratio**0.5
-            if ratio != 1:
+        for lora, sqrt_ratio in zip(ordered_loras, sqrt_ratios):
+            if sqrt_ratio != 1:
                 keys_scaled += 1
-                state_dict[upkeys[i]] *= sqrt_ratio
-                state_dict[downkeys[i]] *= sqrt_ratio
-            scalednorm = updown.norm() * ratio
-            norms.append(scalednorm.item())
+                lora.lora_up.weight.mul_(sqrt_ratio)
+                lora.lora_down.weight.mul_(sqrt_ratio)
 
         return keys_scaled, sum(norms) / len(norms), max(norms)